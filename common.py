@@ -0,0 +1,61 @@
+from urllib.parse import urlparse, urlunparse
+from functools import lru_cache
+
+# Hosts whose query string identifies the page, mapped to the one path it is kept on (None: every path)
+QUERY_KEPT = {
+    'play.google.com': '/store/apps/details',
+    'www.youtube.com': '/watch',
+    'youtube.com': None,
+}
+
+@lru_cache(maxsize=100_000)  # The same links turn up on page after page
+def normalize_url(url):
+    """Remove fragments and trailing slashes, except for specific URLs."""
+    # Nothing to strip and a lower-case scheme: parsing and reassembling would give back the same string.
+    # isprintable() sends hrefs with embedded tabs or newlines, which urlparse removes, down the slow path
+    if (url.startswith(('https://', 'http://')) and not url.endswith('/')
+            and '#' not in url and '?' not in url and ';' not in url and url.isprintable()):
+        return url
+
+    parsed_url = urlparse(url)  # Not urlsplit: normalized URLs deliberately drop ;params
+    netloc = parsed_url.netloc
+    if netloc in QUERY_KEPT and QUERY_KEPT[netloc] in (None, parsed_url.path):
+        return urlunparse((parsed_url.scheme, netloc, parsed_url.path, '', parsed_url.query, ''))
+    return urlunparse((parsed_url.scheme, netloc, parsed_url.path.rstrip('/'), '', '', ''))
+
+def tune_connection(conn):
+    """Apply the WAL settings; everything but journal_mode is per connection, so every connection calls this."""
+    # synchronous=NORMAL only fsyncs the WAL at checkpoints: a power cut can lose the last few commits,
+    # but never corrupts the database. Every page can be re-crawled, so that trade is worth the writes saved
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        PRAGMA busy_timeout=5000;
+        PRAGMA wal_autocheckpoint=1000;
+    ''')
+
+# Last favicon fetched per domain, with the validators needed to revalidate it cheaply
+FAVICON_CACHE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS favicon_cache (
+        domain TEXT PRIMARY KEY,
+        url TEXT,
+        favicon_id TEXT,
+        fetched_at INTEGER,
+        etag TEXT,
+        last_modified TEXT
+    )
+'''
+
+CACHE_FAVICON_SQL = '''
+    INSERT INTO favicon_cache (domain, url, favicon_id, fetched_at, etag, last_modified)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(domain) DO UPDATE SET
+        url = excluded.url,
+        favicon_id = excluded.favicon_id,
+        fetched_at = excluded.fetched_at,
+        etag = excluded.etag,
+        last_modified = excluded.last_modified
+'''
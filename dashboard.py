@@ -1,40 +1,170 @@
-from flask import Flask, render_template, request, jsonify
-from queue import Queue
+from flask import Flask, render_template, request, jsonify, Response
+from flask.json.provider import JSONProvider
+import orjson  # Install with: pip install orjson
+from queue import Queue, SimpleQueue, Full
 import threading
-import requests
 from datetime import datetime
 import sqlite3
 from collections import deque
+from itertools import count, islice
 import threading
 from tqdm.auto import tqdm
-import sys
-from io import StringIO
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import subprocess
 from pathlib import Path
 import time
+import os
+from contextlib import contextmanager
+
+class OrjsonProvider(JSONProvider):
+    """Encode jsonify() and request JSON with orjson instead of the stdlib encoder"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+class RingQueue:
+    """Fixed-capacity FIFO over a preallocated list guarded by a single condition"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = [None] * capacity
+        self.head = self.tail = self.size = 0
+        self.cv = threading.Condition()
+
+    def put(self, item, timeout=None):
+        """Append item, raising queue.Full if no slot frees up within timeout seconds"""
+        with self.cv:
+            if not self.cv.wait_for(lambda: self.size < self.capacity, timeout):
+                raise Full
+            self.buf[self.tail] = item
+            self.tail = (self.tail + 1) % self.capacity
+            self.size += 1
+            self.cv.notify_all()
+
+    def get(self):
+        with self.cv:
+            while self.size == 0:
+                self.cv.wait()
+            item = self.buf[self.head]
+            self.buf[self.head] = None  # Drop the reference so finished tasks can be freed
+            self.head = (self.head + 1) % self.capacity
+            self.size -= 1
+            self.cv.notify_all()
+            return item
+
+    def task_done(self):
+        """Kept for Queue API compatibility; nothing joins on the crawl queue"""
 
 # Queue to store crawl tasks
-crawl_queue = Queue()
+crawl_queue = RingQueue(256)
+QUEUE_PUT_TIMEOUT = 5  # Seconds a request waits for a free slot before answering 503
 
 # Store crawl status
 crawl_status = {}
 
 # Database path
 DB_PATH = "../links.db"
+READ_POOL_SIZE = os.cpu_count() or 4
+
+def _connect():
+    """Open a long-lived connection tuned for the dashboard's polling workload"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL;')
+    conn.execute('PRAGMA synchronous=NORMAL;')
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    conn.execute('PRAGMA mmap_size=268435456;')
+    conn.execute('PRAGMA busy_timeout=30000;')
+    return conn
+
+# Connections are opened once: a pool of readers and one writer owned by its own thread
+_write_queue = SimpleQueue()
+_read_pool = Queue()
+for _ in range(READ_POOL_SIZE):
+    _read_pool.put(_connect())
+
+@contextmanager
+def get_read():
+    """Borrow a read connection from the pool"""
+    conn = _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+# Bumped by the writer after every write so /tasks can tell when its cached body is stale
+_write_version = 0
+_tasks_cache = (None, None)  # (write version, serialized body)
+_boot_tag = f"{time.time_ns():x}"  # Keeps ETags from one run from matching after a restart
+
+def db_writer():
+    """Run every write on one connection so threads never contend for the write lock"""
+    global _write_version
+    conn = _connect()
+    while True:
+        func, reply = _write_queue.get()
+        try:
+            result = func(conn)
+            _write_version += 1
+            reply.put((result, None))
+        except Exception as e:
+            _write_version += 1  # A failed write may still have changed rows
+            reply.put((None, e))
+
+def run_write(func):
+    """Run func(conn) on the writer thread and return its result"""
+    reply = SimpleQueue()
+    _write_queue.put((func, reply))
+    result, error = reply.get()
+    if error is not None:
+        raise error
+    return result
+
+def execute_write(sql, params=()):
+    """Execute a single autocommitted write statement and return the new row id"""
+    return run_write(lambda conn: conn.execute(sql, params).lastrowid)
+
+threading.Thread(target=db_writer, daemon=True).start()
 
 # Add at the top with other globals
-log_buffer = deque(maxlen=1000)  # Store last 1000 log entries
+log_buffer = deque(maxlen=1000)  # Store last 1000 (seq, line) log entries
+log_seq = count(1)  # Monotonic cursor handed to /logs clients
 log_lock = threading.Lock()
 
+# Hot statements live in one place so every call site reuses the same prepared statement
+MARK_RUNNING_SQL = "UPDATE crawl_tasks SET status = 'running' WHERE id = ?"
+MARK_FINISHED_SQL = "UPDATE crawl_tasks SET status = ?, completed_at = ? WHERE id = ?"
+INSERT_TASK_SQL = '''INSERT INTO crawl_tasks 
+                     (url, depth, same_domain, stealth_mode, status, created_at)
+                     VALUES (?, ?, ?, ?, 'pending', ?)'''
+INSERT_STALE_TASK_SQL = '''INSERT INTO crawl_tasks 
+                           (task_type, status, created_at, url)
+                           VALUES ('stale_update', 'pending', ?, NULL)'''
+OUTSTANDING_STALE_SQL = '''SELECT 1 FROM crawl_tasks 
+                           WHERE task_type = 'stale_update' AND status IN ('pending', 'running')
+                           LIMIT 1'''
+RECENT_TASKS_SQL = '''SELECT * FROM crawl_tasks 
+                      ORDER BY created_at DESC 
+                      LIMIT 15'''
+
+# Lets the stale-update coalescing check find pending/running tasks without a scan
+CREATE_TASKS_INDEX = '''CREATE INDEX IF NOT EXISTS idx_crawl_tasks_type_status
+                        ON crawl_tasks (task_type, status)'''
+
 # Modify create_tables() to add task_type column
 def create_tables():
     """Create necessary tables for the dashboard"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS crawl_tasks (
+    execute_write('''CREATE TABLE IF NOT EXISTS crawl_tasks (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         url TEXT NULL,
         depth INTEGER NULL,
@@ -45,28 +175,34 @@ def create_tables():
         completed_at TIMESTAMP,
         task_type TEXT DEFAULT 'crawl'
     )''')
-    
-    conn.commit()
-    conn.close()
+    execute_write(CREATE_TASKS_INDEX)
 
 # Add log capture function
 def capture_log(message):
     with log_lock:
-        log_buffer.append(f"{datetime.now().strftime('%H:%M:%S')} {message}")
+        log_buffer.append((next(log_seq), f"{datetime.now().strftime('%H:%M:%S')} {message}"))
 
-# Add this class for progress capture
-class ProgressCapture:
-    def __init__(self):
-        self.output = StringIO()
-        self._original_stdout = sys.stdout
-        self.pbar = None
+def capture_logs(messages):
+    """Append several messages under one lock acquisition and one timestamp"""
+    stamp = datetime.now().strftime('%H:%M:%S')
+    with log_lock:
+        log_buffer.extend((next(log_seq), f"{stamp} {message}") for message in messages)
+
+class LogBufferHandler(logging.Handler):
+    """Append formatted crawler records to the dashboard log buffer"""
+    def emit(self, record):
+        capture_log(self.format(record))
 
-    def write(self, message):
-        capture_log(message.strip())
-        self._original_stdout.write(message)
+# Crawler threads only enqueue records; one listener thread formats them into log_buffer
+crawler_log_queue = SimpleQueue()
+crawler_log_listener = QueueListener(crawler_log_queue, LogBufferHandler())
 
-    def flush(self):
-        self._original_stdout.flush()
+def attach_crawler_logging():
+    """Route the web.py 'crawler' logger into the dashboard log buffer"""
+    crawler_logger = logging.getLogger('crawler')
+    crawler_logger.setLevel(logging.INFO)
+    crawler_logger.addHandler(QueueHandler(crawler_log_queue))
+    crawler_log_listener.start()
 
 # Modify background_crawler function
 def background_crawler():
@@ -76,200 +212,209 @@ def background_crawler():
         task_id = task['id']
         
         try:
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            c.execute('''UPDATE crawl_tasks 
-                        SET status = 'running' 
-                        WHERE id = ?''', (task_id,))
-            conn.commit()
+            execute_write(MARK_RUNNING_SQL, (task_id,))
             
             if task.get('task_type') == 'stale_update':
                 # Run stale update
                 resultupdater_path = Path(__file__).parent / 'resultupdater.py'
                 process = subprocess.Popen(['python3', str(resultupdater_path)],
                                          stdout=subprocess.PIPE,
-                                         stderr=subprocess.STDOUT,
-                                         text=True)
+                                         stderr=subprocess.STDOUT)
                 
-                for line in process.stdout:
-                    capture_log(f"Stale Update: {line.strip()}")
+                # A pipe read returns whatever is buffered (up to 64 KB), so a burst
+                # of output becomes one batch under the log lock instead of one per line
+                fd = process.stdout.fileno()
+                pending = b''
+                while chunk := os.read(fd, 65536):
+                    pending += chunk
+                    lines = pending.splitlines()
+                    pending = b'' if pending.endswith((b'\n', b'\r')) else lines.pop()
+                    capture_logs(f"Stale Update: {line.decode(errors='replace').strip()}" for line in lines)
+                if pending:
+                    capture_log(f"Stale Update: {pending.decode(errors='replace').strip()}")
                 
+                process.stdout.close()
                 process.wait()
             else:
                 # Regular crawl task
-                progress_capture = ProgressCapture()
-                sys.stdout = progress_capture
-                
-                from web import crawl
-                session = requests.Session()
+                from web import crawl, flush_writes, get_session
+                session = get_session()
                 saved_urls = set()
                 
                 crawl(task['url'], task['depth'], session, task['stealth_mode'], 
                      saved_urls=saved_urls, same_domain=task['same_domain'])
-                
-                sys.stdout = progress_capture._original_stdout
+                flush_writes()  # Only report completion once the crawler's pages are committed
             
-            c.execute('''UPDATE crawl_tasks 
-                        SET status = 'completed',
-                        completed_at = ? 
-                        WHERE id = ?''', (datetime.now().isoformat(), task_id))
-            conn.commit()
+            execute_write(MARK_FINISHED_SQL, ('completed', datetime.now().isoformat(), task_id))
             
         except Exception as e:
             capture_log(f"Error: {str(e)}")
-            if 'progress_capture' in locals():
-                sys.stdout = progress_capture._original_stdout
-            c.execute('''UPDATE crawl_tasks 
-                        SET status = ?,
-                        completed_at = ? 
-                        WHERE id = ?''', (f'failed: {str(e)}', datetime.now().isoformat(), task_id))
-            conn.commit()
+            execute_write(MARK_FINISHED_SQL, (f'failed: {str(e)}', datetime.now().isoformat(), task_id))
         finally:
-            conn.close()
             crawl_queue.task_done()
 
 def reset_running_tasks():
     """Set the state of any 'running' tasks to 'failed'"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('''UPDATE crawl_tasks 
-                 SET status = 'failed'
-                 WHERE status IN ('running', 'pending')''')
-    
-    conn.commit()
-    conn.close()
+    execute_write('''UPDATE crawl_tasks 
+                  SET status = 'failed'
+                  WHERE status IN ('running', 'pending')''')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def enqueue_task(task):
+    """Hand a recorded task to the background crawler, failing it instead of blocking when the queue stays full"""
+    try:
+        crawl_queue.put(task, timeout=QUEUE_PUT_TIMEOUT)
+    except Full:
+        execute_write(MARK_FINISHED_SQL, ('failed: queue full', datetime.now().isoformat(), task['id']))
+        raise
+
 @app.route('/add_task', methods=['POST'])
 def add_task():
-    task = request.json
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('''INSERT INTO crawl_tasks 
-                 (url, depth, same_domain, stealth_mode, status, created_at)
-                 VALUES (?, ?, ?, ?, 'pending', ?)''',
-              (task['url'], task['depth'], task['same_domain'], 
-               task['stealth_mode'], datetime.now().isoformat()))
-    
-    task_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    task = request.get_json()
+    task_id = execute_write(INSERT_TASK_SQL,
+                            (task['url'], task['depth'], task['same_domain'], 
+                             task['stealth_mode'], datetime.now().isoformat()))
     
     # Add task to queue
     task['id'] = task_id
-    crawl_queue.put(task)
+    try:
+        enqueue_task(task)
+    except Full:
+        return jsonify({'error': 'Crawl queue is full, try again later'}), 503
     
     return jsonify({'success': True})
 
 @app.route('/tasks')
 def get_tasks():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    c.execute('''SELECT * FROM crawl_tasks 
-                 ORDER BY created_at DESC 
-                 LIMIT 15''')
-    
-    tasks = [dict(row) for row in c.fetchall()]
-    conn.close()
-    
-    return jsonify(tasks)
+    """Serve the latest tasks, re-querying only after a write has happened"""
+    global _tasks_cache
+    version = _write_version
+    cached_version, body = _tasks_cache
+    if cached_version != version:
+        with get_read() as conn:
+            c = conn.execute(RECENT_TASKS_SQL)
+            columns = [column[0] for column in c.description]
+            
+            tasks = [dict(zip(columns, row)) for row in c.fetchall()]
+        
+        body = orjson.dumps(tasks)
+        _tasks_cache = (version, body)
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(f"{_boot_tag}-{version}")
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # Add new route for logs
 @app.route('/logs')
 def get_logs():
+    """Return only the log lines newer than the client's ?since= cursor"""
+    since = request.args.get('since', 0, type=int)
     with log_lock:
-        return jsonify(list(log_buffer))
+        if not log_buffer:
+            return jsonify({'entries': [], 'cursor': since})
+        first, last = log_buffer[0][0], log_buffer[-1][0]
+        if since > last:  # Cursor is from before a restart; resend everything
+            since = 0
+        # Sequence numbers are contiguous, so the first new entry is found by offset
+        entries = [line for _, line in islice(log_buffer, max(since - first + 1, 0), None)]
+    return jsonify({'entries': entries, 'cursor': last})
     
 @app.route('/update_stale', methods=['POST'])
 def update_stale():
-    """Run resultupdater.py directly and capture output"""
+    """Queue a stale update instead of running resultupdater.py inside the request"""
     try:
-        resultupdater_path = Path(__file__).parent / 'resultupdater.py'
-        process = subprocess.Popen(['python3', str(resultupdater_path)],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT,
-                                 text=True)
-        
-        for line in process.stdout:
-            with log_lock:
-                log_buffer.append(line)
-        
-        process.wait()
-        return jsonify({'success': True})
+        queued = enqueue_stale_update()
+        return jsonify({'success': True, 'queued': queued})
+    except Full:
+        return jsonify({'error': 'Crawl queue is full, try again later'}), 503
     except Exception as e:
-        with log_lock:
-            log_buffer.append(f"Error running resultupdater: {str(e)}")
+        capture_log(f"Error queueing stale update: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-# Modify periodic_stale_update()
+def _insert_stale_task(conn):
+    """Insert a stale update task unless one is already pending or running"""
+    if conn.execute(OUTSTANDING_STALE_SQL).fetchone():
+        return None
+    return conn.execute(INSERT_STALE_TASK_SQL, (datetime.now().isoformat(),)).lastrowid
+
+def enqueue_stale_update():
+    """Record a stale update task and hand it to the background crawler; False if one is outstanding"""
+    # Check and insert run together on the writer thread, so two callers can't both slip through
+    task_id = run_write(_insert_stale_task)
+    if task_id is None:
+        return False
+    
+    # Add task to queue
+    enqueue_task({
+        'id': task_id,
+        'task_type': 'stale_update'
+    })
+    return True
+
+# Set to stop the periodic stale update loop
+_stop = threading.Event()
+
 def periodic_stale_update():
-    """Create stale update tasks every hour"""
+    """Create stale update tasks every 30 minutes, skipping while one is still outstanding"""
     while True:
-        conn = sqlite3.connect(DB_PATH)
+        try:
+            enqueue_stale_update()
+        except Full:
+            capture_log("Crawl queue is full; skipping this stale update")
+        if _stop.wait(1800):
+            return
+
+SCHEMA_VERSION = 1  # Bump when crawl_tasks needs another rebuild
+
+def migrate_database():
+    """Recreate table with nullable columns, once per database"""
+    run_write(_migrate_crawl_tasks)
+
+def _migrate_crawl_tasks(conn):
+    """Rebuild crawl_tasks inside one transaction on the writer connection"""
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
         c = conn.cursor()
         
-        c.execute('''INSERT INTO crawl_tasks 
-                     (task_type, status, created_at, url)
-                     VALUES ('stale_update', 'pending', ?, NULL)''',
-                  (datetime.now().isoformat(),))
+        # Already migrated: skip the full-table copy on every startup
+        if c.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
         
-        task_id = c.lastrowid
-        conn.commit()
-        conn.close()
+        # Move the old table aside and keep only the columns both schemas share
+        c.execute("ALTER TABLE crawl_tasks RENAME TO crawl_tasks_old")
         
-        # Add task to queue
-        crawl_queue.put({
-            'id': task_id,
-            'task_type': 'stale_update'
-        })
+        # Create new table
+        c.execute('''CREATE TABLE crawl_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT NULL,
+            depth INTEGER NULL,
+            same_domain BOOLEAN NULL,
+            stealth_mode BOOLEAN NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            completed_at TIMESTAMP,
+            task_type TEXT DEFAULT 'crawl'
+        )''')
         
-        time.sleep(1800)
-
-def migrate_database():
-    """Recreate table with nullable columns"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Backup existing data
-    c.execute("SELECT * FROM crawl_tasks")
-    existing_data = c.fetchall()
-    
-    # Drop and recreate table
-    c.execute("DROP TABLE IF EXISTS crawl_tasks")
-    
-    # Create new table
-    c.execute('''CREATE TABLE crawl_tasks (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        url TEXT NULL,
-        depth INTEGER NULL,
-        same_domain BOOLEAN NULL,
-        stealth_mode BOOLEAN NULL,
-        status TEXT NOT NULL,
-        created_at TIMESTAMP NOT NULL,
-        completed_at TIMESTAMP,
-        task_type TEXT DEFAULT 'crawl'
-    )''')
-    
-    # Restore data if any
-    if existing_data:
-        c.executemany('''INSERT INTO crawl_tasks VALUES (?,?,?,?,?,?,?,?,?)''', existing_data)
-    
-    conn.commit()
-    conn.close()
+        # Restore data in SQL rather than round-tripping every row through Python
+        old_columns = {row[1] for row in c.execute("PRAGMA table_info(crawl_tasks_old)")}
+        columns = ', '.join(row[1] for row in c.execute("PRAGMA table_info(crawl_tasks)")
+                            if row[1] in old_columns)
+        c.execute(f"INSERT INTO crawl_tasks ({columns}) SELECT {columns} FROM crawl_tasks_old")
+        c.execute("DROP TABLE crawl_tasks_old")  # Takes the old table's indexes with it
+        c.execute(CREATE_TASKS_INDEX)
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 # Modify the if __name__ == '__main__': block to:
 if __name__ == '__main__':
     create_tables()
     migrate_database()  # Add this line
     reset_running_tasks()
+    attach_crawler_logging()
     
     # Start background crawler thread
     crawler_thread = threading.Thread(target=background_crawler, daemon=True)
@@ -279,4 +424,6 @@ if __name__ == '__main__':
     stale_thread = threading.Thread(target=periodic_stale_update, daemon=True)
     stale_thread.start()
     
-    app.run(debug=False)
\ No newline at end of file
+    # threaded=True is Flask's default since 1.0; spelled out because polling /tasks and /logs relies on it
+    app.run(debug=False, threaded=True)
+    _stop.set()
\ No newline at end of file
@@ -2,18 +2,41 @@
 
 import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3Error
 import os
+import tempfile
+import time
 from urllib.parse import urlparse, urljoin
-from hashlib import md5
-from bs4 import BeautifulSoup  # Install with: pip install beautifulsoup4
+from hashlib import blake2b, md5, file_digest
 from tqdm import tqdm  # Install with: pip install tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from PIL import Image  # Install with: pip install pillow
-from io import BytesIO
+import re
+from html import unescape
+from common import tune_connection, FAVICON_CACHE_SCHEMA, CACHE_FAVICON_SQL
 
 DB_PATH = "../links.db"
 FAVICON_DIR = "../favicons"
 os.makedirs(FAVICON_DIR, exist_ok=True)
+# mkstemp creates files as 0600; favicons get the mode open() would give them, so a web server can read them
+_umask = os.umask(0)
+os.umask(_umask)
+FAVICON_MODE = 0o666 & ~_umask
+MAX_THREADS = 100  # Concurrent domains being processed
+HTML_SCAN_BYTES = 16384  # Icon links live in <head>, so only the start of the page is read
+
+LINK_TAG = re.compile(rb'<link\b(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.IGNORECASE)
+TAG_ATTR = re.compile(rb'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+
+# One session shared by every worker: at most MAX_THREADS host pools stay open,
+# instead of a throwaway connection pool for every requests.get call
+SESSION = requests.Session()
+ADAPTER = HTTPAdapter(pool_connections=MAX_THREADS, pool_maxsize=MAX_THREADS,
+                      max_retries=Retry(total=2, backoff_factor=0.3))
+SESSION.mount('https://', ADAPTER)
+SESSION.mount('http://', ADAPTER)
+SESSION.headers.update({'User-Agent': 'NovaSearchCrawler/1.0'})
 
 def confirm_execution():
     """Ask the user for confirmation before proceeding."""
@@ -28,10 +51,11 @@ if not confirm_execution():
     exit(0)
 
 def get_db_connection():
-    """Establish a new database connection and enable WAL mode."""
+    """Establish a new database connection with the WAL settings applied."""
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
-    conn.execute('PRAGMA journal_mode=WAL;')  # Enable WAL mode
+    tune_connection(conn)
+    conn.create_function('netloc', 1, extract_domain, deterministic=True)
     return conn
 
 def extract_domain(url):
@@ -39,37 +63,77 @@ def extract_domain(url):
     parsed_url = urlparse(url)
     return parsed_url.netloc
 
-def get_favicon_url_from_html(domain):
-    """Try to find a favicon URL by parsing the HTML of the page."""
+def find_icon_href(html):
+    """Return the href of the first <link> whose rel mentions icon, whatever the attribute order."""
+    for tag in LINK_TAG.finditer(html):
+        # Only one of the three value groups (double-, single- or unquoted) is ever non-empty
+        attrs = {name.lower(): b''.join(values) for name, *values in TAG_ATTR.findall(tag.group())}
+        href = attrs.get(b'href')
+        if href and b'icon' in attrs.get(b'rel', b'').lower():
+            return unescape(href.decode('utf-8', 'replace')).strip()
+    return None
+
+def get_favicon_url_from_html(domain, session=SESSION):
+    """Try to find a favicon URL by scanning the start of the home page."""
     try:
-        response = requests.get(f"https://{domain}", timeout=5)
-        soup = BeautifulSoup(response.content, "html.parser")
-        
-        icon_link = soup.find("link", rel=lambda value: value and "icon" in value.lower())
-        if icon_link and icon_link.get("href"):
-            return urljoin(f"https://{domain}", icon_link["href"])
+        with session.get(f"https://{domain}", timeout=5, stream=True) as response:
+            # Read just enough of the page to cover <head>, then drop the connection
+            html = b''
+            for chunk in response.iter_content(4096):
+                html += chunk
+                if len(html) >= HTML_SCAN_BYTES:
+                    break
+            href = find_icon_href(html)
+            if href:
+                return urljoin(response.url, href)  # Relative to wherever the home page redirected
     except requests.RequestException:
         pass  # Fail silently
 
     return f"https://{domain}/favicon.ico"
 
-def convert_to_ico(image_content, output_path):
-    """Convert an image to ICO format and save it."""
-    with Image.open(BytesIO(image_content)) as img:
-        img.save(output_path, format='ICO')
+def existing_favicon_hashes():
+    """Map the hash of every favicon already on disk to its file name with a single directory scan."""
+    with os.scandir(FAVICON_DIR) as entries:
+        return {entry.name.partition('.')[0]: entry.name for entry in entries if entry.is_file()}
 
-def download_favicon(domain):
-    """Download the favicon for a given domain."""
-    favicon_url = get_favicon_url_from_html(domain)
-    headers = {'User-Agent': 'NovaSearchCrawler/1.0'}
+def content_hash():
+    """Hash favicon files are named by, shared with web.py: a 16-byte blake2b of the body."""
+    return blake2b(digest_size=16)
 
+def rehash_legacy_file(name):
+    """Rename a favicon named by its URL's hash to the hash of its content; None if it is gone."""
+    path = os.path.join(FAVICON_DIR, name)
     try:
-        response = requests.get(favicon_url, headers=headers, timeout=5)
-        if response.status_code == 200:
+        with open(path, "rb") as f:
+            favicon_hash = file_digest(f, content_hash).hexdigest()
+        os.replace(path, os.path.join(FAVICON_DIR, f"{favicon_hash}.{name.partition('.')[2]}"))
+        return favicon_hash
+    except OSError:
+        return None  # Another domain sharing this icon may have renamed it first
+
+def download_favicon(domain, existing, session=SESSION, cached=None):
+    """Download the favicon for a given domain, returning (domain, favicon_id, favicon_cache row or None)."""
+    favicon_url = get_favicon_url_from_html(domain, session)
+    if cached and cached[0] == favicon_url and cached[1] in existing:
+        return domain, cached[1], None  # Fetched on an earlier run; only the DB needs updating
+
+    # Older files are named by a hash of their URL (blake2b, MD5 before that); rehash instead of refetching
+    for legacy_hash in (blake2b(favicon_url.encode(), digest_size=16), md5(favicon_url.encode())):
+        legacy_name = existing.get(legacy_hash.hexdigest())
+        favicon_hash = legacy_name and rehash_legacy_file(legacy_name)
+        if favicon_hash:
+            return domain, favicon_hash, (domain, favicon_url, favicon_hash, int(time.time()), None, None)
+
+    try:
+        # Stream so the body is only read once the headers say it is a usable image
+        with session.get(favicon_url, timeout=5, stream=True) as response:
+            if response.status_code != 200:
+                return domain, None, None
+
             content_type = response.headers.get('Content-Type', '').lower()
             if content_type.startswith('text/html'):
                 tqdm.write(f"HTML content received instead of image for {domain}")
-                return domain, None
+                return domain, None, None
 
             ext = {
                 'image/png': 'png',
@@ -83,29 +147,60 @@ def download_favicon(domain):
 
             if ext is None:
                 tqdm.write(f"Unknown favicon type for {domain}: {content_type}")
-                return domain, None
-
-            favicon_hash = md5(favicon_url.encode()).hexdigest()
-            file_path = os.path.join(FAVICON_DIR, f"{favicon_hash}.{ext}")
-
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-
-            return domain, favicon_hash
-    except requests.RequestException:
+                return domain, None, None
+
+            # Copied from the socket in 64 KiB chunks into a temp file, which only takes the final
+            # name once complete, so an interrupted download can't pass as cached on the next run.
+            # Named by content like web.py does, so both scripts give an icon the same favicon_id.
+            response.raw.decode_content = True  # Undo any gzip/br transfer encoding while copying
+            digest = content_hash()
+            fd, partial_path = tempfile.mkstemp(suffix='.partial', dir=FAVICON_DIR)
+            os.fchmod(fd, FAVICON_MODE)  # os.replace keeps the temp file's mode
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in iter(lambda: response.raw.read(65536), b''):
+                        digest.update(chunk)
+                        f.write(chunk)
+                favicon_hash = digest.hexdigest()
+                os.replace(partial_path, os.path.join(FAVICON_DIR, f"{favicon_hash}.{ext}"))
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+            return domain, favicon_hash, (domain, favicon_url, favicon_hash, int(time.time()),
+                                          response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    except (requests.RequestException, Urllib3Error):  # Reading response.raw raises urllib3's own errors
         pass
 
-    return domain, None
-
-def batch_update_favicon_ids(updates):
-    """Batch update the favicon IDs in the database."""
+    return domain, None, None
+
+def ensure_domain_column(conn):
+    """Add, index and backfill pages.domain so favicons can be matched by host equality."""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(pages)")}
+    with conn:
+        if "domain" not in columns:
+            conn.execute("ALTER TABLE pages ADD COLUMN domain TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_domain_prio ON pages(domain, priority DESC)")
+        conn.execute("DROP INDEX IF EXISTS idx_pages_domain")  # Covered by the composite index's leading column
+        # Rows written by crawlers that don't fill the column yet are picked up on every run
+        conn.execute("UPDATE pages SET domain = netloc(url) WHERE domain IS NULL AND url IS NOT NULL")
+
+def ensure_favicon_cache(conn):
+    """Create web.py's favicon_cache table if this database has never seen web.py."""
+    with conn:
+        conn.execute(FAVICON_CACHE_SCHEMA)
+
+def batch_update_favicon_ids(updates, cache_rows=()):
+    """Batch update the favicon IDs, and the favicon_cache rows web.py reads, in one transaction."""
     conn = get_db_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.executemany(
-            "UPDATE pages SET favicon_id = ? WHERE url LIKE ?", updates
-        )
+        cursor.execute('BEGIN IMMEDIATE')
+        # Each domain is an index lookup on pages.domain
+        cursor.executemany("UPDATE pages SET favicon_id = ? WHERE domain = ?",
+                           ((favicon_id, domain) for domain, favicon_id in updates))
+        cursor.executemany(CACHE_FAVICON_SQL, cache_rows)
         conn.commit()
     except sqlite3.Error as e:
         tqdm.write(f"Database update error: {e}")
@@ -115,26 +210,35 @@ def batch_update_favicon_ids(updates):
 def crawl_for_favicons():
     """Main function to crawl and update favicons using multithreading."""
     conn = get_db_connection()
+    ensure_domain_column(conn)
+    ensure_favicon_cache(conn)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT DISTINCT url FROM pages")
-    urls = cursor.fetchall()
+    # Distinct values straight off idx_pages_domain_prio rather than building a set from every URL
+    cursor.execute("SELECT DISTINCT domain FROM pages WHERE domain IS NOT NULL")
+    domains = [row["domain"] for row in cursor]
+    # The icon URL and file each domain was last given, by either script
+    cached = {row["domain"]: (row["url"], row["favicon_id"])
+              for row in cursor.execute("SELECT domain, url, favicon_id FROM favicon_cache")}
     conn.close()
 
-    domains = {extract_domain(row["url"]) for row in urls}
-
+    existing = existing_favicon_hashes()
     updates = []
+    cache_rows = []
 
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        futures = {executor.submit(download_favicon, domain): domain for domain in domains}
+    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+        futures = {executor.submit(download_favicon, domain, existing, SESSION, cached.get(domain)): domain
+                   for domain in domains}
 
         for future in tqdm(as_completed(futures), total=len(futures), desc="Processing domains", unit="domain"):
-            domain, favicon_id = future.result()
+            domain, favicon_id, cache_row = future.result()
             if favicon_id:
-                updates.append((favicon_id, f"%{domain}%"))
+                updates.append((domain, favicon_id))
+            if cache_row:
+                cache_rows.append(cache_row)
 
     if updates:
-        batch_update_favicon_ids(updates)
+        batch_update_favicon_ids(updates, cache_rows)
 
 if __name__ == "__main__":
     confirm_execution()
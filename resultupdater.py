@@ -1,13 +1,31 @@
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree
+from urllib.parse import urlsplit
 import sqlite3
 from tqdm import tqdm
 import os
 import time
 import random
+import threading
+from queue import Queue, SimpleQueue, Empty
 from datetime import datetime, timedelta, UTC
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter, deque
+from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from common import normalize_url, tune_connection
+
+log = logging.getLogger('resultupdater')
+
+class TqdmHandler(logging.Handler):
+    """Emit log records through tqdm.write so the progress bar stays intact"""
+    def emit(self, record):
+        tqdm.write(self.format(record))
 
 # --- Constants ---
 DB_PATH = "../links.db"
@@ -21,131 +39,382 @@ USER_AGENTS = [
     "Dalvik/2.1.0 (Linux; U; Android 11; Pixel 3a XL Build/RQ2A.210305.006)",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
 ]
+USER_AGENT_CYCLE = cycle(random.sample(USER_AGENTS, len(USER_AGENTS)))  # Rotated with next() instead of random.choice
 MAX_THREADS = 50  # Adjust based on system performance
+WRITE_BATCH_SIZE = 200  # Results committed per transaction by the writer thread
+WRITE_BATCH_SECONDS = 1.0  # Longest a result waits before its batch is committed
+WAL_CHECKPOINT_BYTES = 64 * 1024 * 1024  # Truncate the WAL once it grows past this
+STALE_PAGE_SIZE = 1000  # Stale URLs read per query
+MAX_PENDING = MAX_THREADS * 4  # Submitted-but-unfinished URLs kept in memory
+HEAD_CHUNK_SIZE = 16384  # Bytes fed to the head parser at a time
+MAX_HEAD_BYTES = 512 * 1024  # Stop reading a page here even if </head> never shows up
+MAX_PER_HOST = 4  # Concurrent requests allowed against a single host
+MAX_RETRY_DELAY = 60  # Upper bound in seconds on a 429 backoff, whatever Retry-After says
 
 # --- Database Setup ---
+# Kept as constants so every batch reuses the same cached prepared statement.
+# SQLite stamps last_crawled itself, in the ISO-8601 UTC text stale_cutoff() compares against
+UPSERT_SQL = '''
+    INSERT INTO pages (url, title, description, keywords, priority, last_crawled, domain)
+    VALUES (?, ?, ?, ?, 0, strftime('%Y-%m-%dT%H:%M:%f', 'now') || '+00:00', ?)
+    ON CONFLICT(url) DO UPDATE SET
+        title = excluded.title,
+        description = excluded.description,
+        keywords = excluded.keywords,
+        last_crawled = excluded.last_crawled,
+        domain = excluded.domain
+'''
+DELETE_SQL = 'DELETE FROM pages WHERE url = ?'
+# Folds a row's priority and favicon into the row already at its normalized URL, if there is one
+MERGE_SQL = '''
+    UPDATE pages SET
+        priority = priority + COALESCE((SELECT priority FROM pages WHERE url = :old), 0),
+        favicon_id = COALESCE(favicon_id, (SELECT favicon_id FROM pages WHERE url = :old))
+    WHERE url = :new
+'''
+# Moves a row onto its normalized URL; ignored when that URL already has a row of its own
+RENAME_SQL = 'UPDATE OR IGNORE pages SET url = ?, domain = ? WHERE url = ?'
+EXISTS_SQL = 'SELECT 1 FROM pages WHERE url = ?'
+
 def connect_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('PRAGMA journal_mode=WAL;')
+    # Autocommit: the writer opens its own BEGIN IMMEDIATE around each batch
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=256)
+    tune_connection(conn)
     return conn
 
-def get_stale_urls(conn):
-    """Retrieve URLs where last_crawled is null or older than 14 days."""
-    cutoff_date = (datetime.now(UTC) - timedelta(days=14)).isoformat()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT url FROM pages
+def close_db(conn):
+    """Let SQLite refresh planner statistics before closing the connection."""
+    conn.execute('PRAGMA optimize;')
+    conn.close()
+
+def checkpoint_if_large(conn):
+    """Truncate the WAL when autocheckpoints have not kept it small."""
+    try:
+        wal_size = os.path.getsize(DB_PATH + "-wal")
+    except OSError:
+        return
+    if wal_size > WAL_CHECKPOINT_BYTES:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+
+def stale_cutoff():
+    """Timestamp before which a page counts as stale (14 days ago)."""
+    return (datetime.now(UTC) - timedelta(days=14)).isoformat()
+
+def count_stale_urls(conn, cutoff_date):
+    """Count URLs where last_crawled is null or older than the cutoff."""
+    return conn.execute('''
+        SELECT COUNT(*) FROM pages
         WHERE last_crawled IS NULL OR last_crawled < ?
-    ''', (cutoff_date,))
-    return [row[0] for row in cursor.fetchall()]
+    ''', (cutoff_date,)).fetchone()[0]
+
+def get_stale_urls(conn, cutoff_date):
+    """Yield URLs where last_crawled is null or older than the cutoff, one page of rows at a time."""
+    # Keyset pagination on rowid: each query is a short read, so the writer never waits on a long scan
+    last_rowid = 0
+    while True:
+        rows = conn.execute('''
+            SELECT rowid, url FROM pages
+            WHERE rowid > ? AND (last_crawled IS NULL OR last_crawled < ?)
+            ORDER BY rowid
+            LIMIT ?
+        ''', (last_rowid, cutoff_date, STALE_PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        for _, url in rows:
+            yield url
 
 # --- Helper Functions ---
+# Built once; get_headers only adds the rotated User-Agent and the Referer in stealth mode
+BASE_HEADERS = {
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': DEFAULT_ACCEPT_ENCODING,  # Only what urllib3 can decode; includes br when brotli is installed
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'DNT': '0',
+    'User-Agent': DEFAULT_USER_AGENT
+}
+STEALTH_HEADERS = {**BASE_HEADERS, 'DNT': '1'}
+
 def get_headers(stealth_mode, referrer=None):
-    headers = {
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-        'DNT': '1' if stealth_mode else '0',
-        'User-Agent': random.choice(USER_AGENTS) if stealth_mode else DEFAULT_USER_AGENT
-    }
-    if stealth_mode and referrer:
+    if not stealth_mode:
+        return BASE_HEADERS  # requests merges this into a new dict, so sharing it is safe
+
+    headers = STEALTH_HEADERS.copy()
+    headers['User-Agent'] = next(USER_AGENT_CYCLE)
+    if referrer:
         headers['Referer'] = referrer
     return headers
 
-def normalize_url(url):
-    return urlparse(url).geturl().rstrip('/')
-
-def update_page(conn, url, title, description, keywords):
-    current_time = datetime.now(UTC).isoformat()
-    conn.execute('''
-        UPDATE pages
-        SET title = ?, description = ?, keywords = ?, last_crawled = ?
-        WHERE url = ?
-    ''', (title, description, keywords, current_time, url))
-    conn.commit()
-
-def save_page(conn, url, title, description, keywords):
-    current_time = datetime.now(UTC).isoformat()
-    conn.execute('''
-        INSERT INTO pages (url, title, description, keywords, priority, last_crawled)
-        VALUES (?, ?, ?, ?, 0, ?)
-    ''', (url, title, description, keywords, current_time))
-    conn.commit()
-
-def remove_url(conn, url):
-    """Remove a URL from the database."""
-    conn.execute('DELETE FROM pages WHERE url = ?', (url,))
-    conn.commit()
-    tqdm.write(f"Removed: {url} (status: 4xx error)")
-
-def crawl(url, session, conn, stealth_mode, retries=3):
+def ensure_indexes(conn):
+    """Create the columns and indexes the stale scan and the UPSERT rely on."""
+    if 'domain' not in {row[1] for row in conn.execute('PRAGMA table_info(pages)')}:
+        conn.execute('ALTER TABLE pages ADD COLUMN domain TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pages_domain_prio ON pages(domain, priority DESC)')
+    conn.execute('DROP INDEX IF EXISTS idx_pages_domain')  # Covered by the composite index's leading column
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pages_last_crawled ON pages(last_crawled)')
+    ensure_unique_urls(conn)
+
+def ensure_unique_urls(conn):
+    """Create the unique index on pages.url that the UPSERT conflicts on."""
     try:
-        response = session.get(url, headers=get_headers(stealth_mode), timeout=10)
-        
-        # Handle different status codes
-        if response.status_code == 429:  # Too Many Requests, retry later
-            if retries > 0:
-                tqdm.write(f"429 Too Many Requests for {url}. Retrying in 5 seconds...")
-                time.sleep(5)
-                return crawl(url, session, conn, stealth_mode, retries - 1)
-            else:
-                tqdm.write(f"Max retries reached for {url}. Skipping.")
-                return
-        elif 400 <= response.status_code < 500:  # Remove 4xx errors (excluding 429) from the database
-            remove_url(conn, url)
-            return
-        elif response.status_code != 200 or 'text/html' not in response.headers.get('Content-Type', ''):
-            tqdm.write(f"Skipping: {url} (status: {response.status_code})")
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pages_url ON pages(url)')
+    except sqlite3.IntegrityError:
+        # Older databases may hold duplicate rows; keep the first copy of each URL
+        log.info("Removing duplicate URLs before creating the unique index...")
+        with conn:
+            conn.execute('DELETE FROM pages WHERE rowid NOT IN (SELECT MIN(rowid) FROM pages GROUP BY url)')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pages_url ON pages(url)')
+
+def save_pages(conn, pages):
+    """Insert or refresh (url, title, description, keywords, domain) rows in one statement each."""
+    conn.executemany(UPSERT_SQL, pages)
+    for page in pages:
+        log.debug("Saved: %s", page[0])
+
+def merge_urls(conn, renames):
+    """Move (old, new) rows onto their normalized URL, folding them into it when that row already exists."""
+    conn.executemany(MERGE_SQL, ({'old': old, 'new': new} for old, new in renames))
+    conn.executemany(RENAME_SQL, ((new, urlsplit(new).netloc, old) for old, new in renames))
+    conn.executemany(DELETE_SQL, ((old,) for old, _ in renames))  # Only rows the rename skipped remain
+    for old, new in renames:
+        log.debug("Merged: %s -> %s", old, new)
+
+def remove_urls(conn, urls):
+    """Remove URLs from the database."""
+    conn.executemany(DELETE_SQL, ((url,) for url in urls))
+    for url in urls:
+        log.debug("Removed: %s (status: 4xx error)", url)
+
+def db_writer(write_queue):
+    """Apply worker results on one connection, committing in batches until a None sentinel arrives."""
+    conn = connect_db()
+    done = False
+    while not done:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE and batch[-1] is not None:
+            try:
+                batch.append(write_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                break
+        if batch[-1] is None:
+            done = True
+            batch.pop()
+        if not batch:
+            continue
+
+        renames = [fields for action, *fields in batch if action == "rename"]
+        pages = [fields for action, *fields in batch if action == "upsert"]
+        urls = [fields[0] for action, *fields in batch if action == "delete"]
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            merge_urls(conn, renames)  # First, so the UPSERTs below land on the merged rows
+            save_pages(conn, pages)
+            remove_urls(conn, urls)
+            conn.commit()
+            checkpoint_if_large(conn)
+        except sqlite3.Error as e:
+            conn.rollback()
+            log.error("Database error, dropped %d results: %s", len(batch), e)
+    close_db(conn)
+
+def _read_head_events(parser, fields):
+    """Record title/meta values from pending parser events; True once the head is over."""
+    for event, element in parser.read_events():
+        if element.tag == 'body' or (event == 'end' and element.tag == 'head'):
+            return True
+        if event == 'end' and element.tag == 'title':
+            fields.setdefault('title', element.text or '')
+        elif event == 'start' and element.tag == 'meta':
+            name = element.get('name', '').lower()
+            if name in ('description', 'keywords'):
+                fields.setdefault(name, element.get('content', ''))
+    return False
+
+def parse_head(chunks):
+    """Extract (title, description, keywords) from HTML chunks without parsing past <head>."""
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    fields = {}
+    for chunk in chunks:
+        parser.feed(chunk)
+        if _read_head_events(parser, fields):
+            break
+    else:
+        try:
+            parser.close()
+        except etree.LxmlError:
+            pass  # Empty or truncated document; keep whatever was found
+        _read_head_events(parser, fields)
+    return fields.get('title', ''), fields.get('description', ''), fields.get('keywords', '')
+
+def retry_delay(response, attempt):
+    """Seconds to wait after a 429: Retry-After when it is numeric, else exponential backoff, plus jitter."""
+    try:
+        delay = float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        delay = 2 ** attempt
+    return min(max(delay, 0), MAX_RETRY_DELAY) + random.random()
+
+def head_chunks(response):
+    """Yield the streamed body in HEAD_CHUNK_SIZE pieces, giving up after MAX_HEAD_BYTES."""
+    received = 0
+    for chunk in response.iter_content(HEAD_CHUNK_SIZE):
+        yield chunk
+        received += len(chunk)
+        if received >= MAX_HEAD_BYTES:
             return
 
-        # Proceed with parsing and saving page data if response is successful
-        soup = BeautifulSoup(response.content, 'lxml')
-        title = soup.title.string if soup.title else ''
-        description = soup.find('meta', attrs={'name': 'description'})
-        description = description['content'] if description else ''
-        keywords = soup.find('meta', attrs={'name': 'keywords'})
-        keywords = keywords['content'] if keywords else ''
-
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM pages WHERE url = ?', (url,))
-        if cursor.fetchone():
-            update_page(conn, url, title, description, keywords)
-            tqdm.write(f"Updated: {url}")
-        else:
-            save_page(conn, url, title, description, keywords)
-            tqdm.write(f"Saved: {url}")
+def is_html(response):
+    """Judge from the headers alone whether a response is an HTML (or XHTML) page."""
+    return 'html' in response.headers.get('Content-Type', '').lower()
+
+def handle_response(url, response):
+    """Turn a non-429 response into a result tuple for the writer thread, or None to skip it."""
+    # Handle different status codes
+    if 400 <= response.status_code < 500:  # Remove 4xx errors (excluding 429) from the database
+        return ("delete", url)
+    elif response.status_code != 200 or not is_html(response):
+        log.debug("Skipping: %s (status: %s)", url, response.status_code)
+        return
+
+    # Proceed with parsing; only the body up to </head> (or MAX_HEAD_BYTES) is ever downloaded
+    title, description, keywords = parse_head(head_chunks(response))
+
+    return ("upsert", url, title, description, keywords, urlsplit(url).netloc)
+
+def crawl(url, session, stealth_mode, retries=3):
+    """Fetch and parse a URL, returning a result tuple for the writer thread or None."""
+    try:
+        for attempt in range(retries + 1):
+            with session.get(url, headers=get_headers(stealth_mode), timeout=10, stream=True) as response:
+                if response.status_code != 429:
+                    return handle_response(url, response)
+                delay = retry_delay(response, attempt)
+            if attempt == retries:
+                log.warning("Max retries reached for %s. Skipping.", url)
+                return
+            # Too Many Requests: back off, keeping the host's slot so its other URLs wait too
+            log.debug("429 Too Many Requests for %s. Retrying in %.1f seconds...", url, delay)
+            time.sleep(delay)
 
     except Exception as e:
-        tqdm.write(f"Error crawling {url}: {e}")
+        log.warning("Error crawling %s: %s", url, e)
 
 # --- Multithreading Logic ---
-def process_url(url, stealth_mode):
-    """Wrapper function for multithreading."""
-    conn = connect_db()
+def get_session():
+    """Build the Session all workers share, so a host's keep-alive connections serve every thread."""
     session = requests.Session()
-    crawl(url, session, conn, stealth_mode)
-    conn.close()
+    # main() keeps each host at MAX_PER_HOST requests in flight, so that is all a host's pool needs;
+    # 5xx and connection errors are retried here, 429s by crawl() itself
+    adapter = HTTPAdapter(pool_connections=MAX_THREADS * 2, pool_maxsize=MAX_PER_HOST,
+                          max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                                            raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def process_url(url, session, stealth_mode, write_queue):
+    """Wrapper function for multithreading; only the writer thread touches the database."""
+    result = crawl(url, session, stealth_mode)
+    if result:
+        write_queue.put(result)
 
 # --- Main Logic ---
+def collect_results(futures, progress):
+    """Report exceptions from finished futures and advance the progress bar."""
+    for future in futures:
+        try:
+            future.result()  # Raise exceptions if any occurred during crawling
+        except Exception as e:
+            log.error("Error during crawling: %s", e)
+        progress.update()
+
 def main():
     conn = connect_db()
-    tqdm.write("Fetching stale URLs...")
-    stale_urls = get_stale_urls(conn)
-    conn.close()
+    log.info("Fetching stale URLs...")
+    ensure_indexes(conn)
+    cutoff_date = stale_cutoff()
+    total = count_stale_urls(conn, cutoff_date)
 
-    tqdm.write(f"Found {len(stale_urls)} URLs to re-crawl.")
+    log.info("Found %d URLs to re-crawl.", total)
 
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = [executor.submit(process_url, url, True) for url in stale_urls]
-        for future in tqdm(as_completed(futures), total=len(stale_urls), desc="Crawling"):
-            try:
-                future.result()  # Raise exceptions if any occurred during crawling
-            except Exception as e:
-                tqdm.write(f"Error during crawling: {e}")
+    write_queue = Queue(maxsize=WRITE_BATCH_SIZE * 5)
+    writer = threading.Thread(target=db_writer, args=(write_queue,))
+    writer.start()
+    session = get_session()
+
+    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor, tqdm(total=total, desc="Crawling") as progress:
+        # Submit lazily so memory stays bounded by MAX_PENDING rather than the number of stale URLs.
+        # Stale rows come out clustered by host, so the per-host cap is applied here, when submitting:
+        # a URL for a host with MAX_PER_HOST requests in flight is held back instead of occupying a
+        # worker that would only wait on it. All three maps only ever hold hosts with work outstanding.
+        running = {}  # future -> host it is fetching from
+        active = Counter()  # host -> requests in flight
+        held = {}  # host -> deque of URLs waiting for one of the host's requests to finish
+        held_count = 0
+
+        def submit(url, host):
+            running[executor.submit(process_url, url, session, True, write_queue)] = host
+            active[host] += 1
 
-    tqdm.write("Crawl complete.")
+        def reap():
+            nonlocal held_count
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            collect_results(done, progress)
+            for future in done:
+                host = running.pop(future)
+                active[host] -= 1
+                queued = held.get(host)
+                if queued:
+                    submit(queued.popleft(), host)  # The freed slot goes to the host's next URL
+                    held_count -= 1
+                    if not queued:
+                        del held[host]
+                elif not active[host]:
+                    del active[host]
+
+        merged = set()  # Normalized URLs already queued for a non-canonical row
+        for url in get_stale_urls(conn, cutoff_date):
+            normalized = normalize_url(url)
+            if normalized != url:
+                # Fold the row into its normalized form; the unique index already rules out
+                # duplicates among canonical rows, so only these need checking
+                write_queue.put(("rename", url, normalized))
+                if normalized in merged or conn.execute(EXISTS_SQL, (normalized,)).fetchone():
+                    progress.update()  # The canonical row is crawled on its own when stale
+                    continue
+                merged.add(normalized)
+                url = normalized
+            host = urlsplit(url).netloc
+            if active[host] < MAX_PER_HOST:
+                submit(url, host)
+            else:
+                held.setdefault(host, deque()).append(url)
+                held_count += 1
+            while len(running) + held_count >= MAX_PENDING:
+                reap()
+        while running:
+            reap()
+
+    close_db(conn)
+    write_queue.put(None)  # Flush the last batch and stop the writer
+    writer.join()
+    log.info("Crawl complete.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Re-crawl pages that have not been refreshed in 14 days.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every saved, removed and skipped URL")
+    args = parser.parse_args()
+
+    # Workers only enqueue records; the listener thread does the formatting and terminal I/O
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, TqdmHandler())
+    log.addHandler(QueueHandler(log_queue))
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    listener.start()
+    try:
+        main()
+    finally:
+        listener.stop()
@@ -1,20 +1,55 @@
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse, urlunparse
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.etree
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
 import sqlite3
 from tqdm import tqdm
 import os
+import re
 import random
-from hashlib import md5
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tempfile
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 import sys
 import argparse
-from datetime import datetime, UTC
+import logging
+import threading
+import time
+from queue import Queue, Empty
+from collections import deque
+from itertools import cycle, groupby
+from functools import lru_cache
+from common import normalize_url, tune_connection, FAVICON_CACHE_SCHEMA, CACHE_FAVICON_SQL
+
+log = logging.getLogger('crawler')
+
+class TqdmHandler(logging.Handler):
+    """Emit log records through tqdm.write so progress bars stay intact"""
+    def emit(self, record):
+        tqdm.write(self.format(record))
 
 # Initialize SQLite DB
 DB_PATH = "../links.db"
 FAVICON_DIR = "../favicons"
 os.makedirs(FAVICON_DIR, exist_ok=True)
+# mkstemp creates files as 0600; favicons get the mode open() would give them, so a web server can read them
+_umask = os.umask(0)
+os.umask(_umask)
+FAVICON_MODE = 0o666 & ~_umask
+WRITE_BATCH_SIZE = 500  # Queued writes committed per transaction
+WRITE_BATCH_SECONDS = 0.1  # Longest a write waits before its batch is committed
+WRITE_QUEUE_SIZE = 10_000  # Writes waiting on the writer before crawl threads block
+CHECKPOINT_SECONDS = 30  # Interval between background WAL checkpoints
+CRAWL_THREADS = 10  # Pages fetched at once; matches requests' default pool size per host
+MAX_PER_HOST = 4  # Concurrent requests to any one host
+HEAD_CHUNK_SIZE = 16384  # Bytes fed to the parser at a time
+MAX_HEAD_BYTES = 512 * 1024  # A leaf page's head is given up on after this much
+MAX_PAGE_BYTES = 2 * 1024 * 1024  # Pages followed for links are truncated here
+FAVICON_THREADS = 50  # Favicon downloads in flight; each one is a different host
+FAVICON_TTL = 7 * 24 * 3600  # Seconds a cached favicon is trusted before asking the server again
 
 # --- Database Functions ---
 def check_db_exists():
@@ -41,7 +76,8 @@ def create_db():
             keywords TEXT,
             priority INTEGER DEFAULT 0,
             favicon_id TEXT,
-            last_crawled TIMESTAMP
+            last_crawled TIMESTAMP,
+            domain TEXT
         )
     ''')
     conn.commit()
@@ -51,7 +87,7 @@ def create_db():
 check_db_exists()  # Check DB at startup
 
 conn = sqlite3.connect(DB_PATH)
-conn.execute('PRAGMA journal_mode=WAL;')  # Enable WAL mode
+tune_connection(conn)
 c = conn.cursor()
 
 c.execute('''
@@ -65,6 +101,116 @@ c.execute('''
     )
 ''')
 
+# save_page's UPSERT conflicts on url, which needs a unique index
+try:
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pages_url ON pages(url)')
+except sqlite3.IntegrityError:
+    # Older databases may hold duplicate rows; keep the first copy of each URL
+    with conn:
+        c.execute('DELETE FROM pages WHERE rowid NOT IN (SELECT MIN(rowid) FROM pages GROUP BY url)')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_pages_url ON pages(url)')
+
+# Favicons are assigned per host, so pages carry an indexed domain column instead of being matched with LIKE.
+# The index also orders each domain's pages by priority; its leading column serves plain domain lookups,
+# so the older single-column index is dropped rather than maintained on every write
+if 'domain' not in {row[1] for row in c.execute('PRAGMA table_info(pages)')}:
+    c.execute('ALTER TABLE pages ADD COLUMN domain TEXT')
+c.execute('CREATE INDEX IF NOT EXISTS idx_pages_domain_prio ON pages(domain, priority DESC)')
+c.execute('DROP INDEX IF EXISTS idx_pages_domain')
+conn.create_function('netloc', 1, lambda url: urlsplit(url).netloc, deterministic=True)
+with conn:
+    c.execute('UPDATE pages SET domain = netloc(url) WHERE domain IS NULL AND url IS NOT NULL')
+
+c.execute(FAVICON_CACHE_SCHEMA)
+
+# --- Write Queue ---
+# Crawl code only enqueues (sql, params); one thread owns the write connection and commits in batches
+write_queue = Queue(maxsize=WRITE_QUEUE_SIZE)  # Bounded, so a slow disk slows the crawl instead of filling memory
+
+def db_writer():
+    """Execute queued writes on a dedicated connection, one transaction per batch."""
+    writer_conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=512)
+    tune_connection(writer_conn)
+    writer_conn.execute('PRAGMA wal_autocheckpoint=0;')  # wal_checkpointer does it, so no COMMIT stalls on one
+    writer_conn.execute('PRAGMA cache_size=-131072;')  # 128 MB page cache for the index lookups behind each UPSERT
+    while True:
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except Empty:
+                break
+
+        try:
+            writer_conn.execute('BEGIN IMMEDIATE')
+            # Consecutive writes of the same statement are prepared once and run through executemany
+            for sql, group in groupby(batch, key=lambda item: item[0]):
+                rows = [params for _, params in group]
+                writer_conn.execute('SAVEPOINT write_group')
+                try:
+                    writer_conn.executemany(sql, rows)
+                except sqlite3.Error:
+                    # executemany stops at the first bad row: undo the rows it did apply, then redo
+                    # the group one row at a time so only the rows that fail on their own are lost
+                    writer_conn.execute('ROLLBACK TO write_group')
+                    for params in rows:
+                        try:
+                            writer_conn.execute(sql, params)
+                        except sqlite3.Error as e:
+                            log.error('Database error, dropped %r for %s: %s', params, ' '.join(sql.split()), e)
+                writer_conn.execute('RELEASE write_group')
+            writer_conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if writer_conn.in_transaction:
+                writer_conn.execute('ROLLBACK')
+            log.error('Database error, dropped %d writes: %s', len(batch), e)
+        finally:
+            for _ in batch:
+                write_queue.task_done()
+
+def queue_write(sql, params=()):
+    """Hand a write statement to the writer thread."""
+    write_queue.put((sql, params))
+
+def flush_writes():
+    """Block until every queued write has been committed."""
+    write_queue.join()
+
+def wal_checkpointer():
+    """Copy committed WAL pages into the database every CHECKPOINT_SECONDS without blocking the writer."""
+    checkpoint_conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    tune_connection(checkpoint_conn)
+    while True:
+        time.sleep(CHECKPOINT_SECONDS)
+        try:
+            checkpoint_conn.execute('PRAGMA wal_checkpoint(PASSIVE);')
+        except sqlite3.Error as e:
+            log.error('Checkpoint error: %s', e)
+
+threading.Thread(target=db_writer, daemon=True).start()
+threading.Thread(target=wal_checkpointer, daemon=True).start()
+
+# Reads never wait on the writer under WAL; each crawling thread keeps its own read-only connection
+read_local = threading.local()
+
+def get_read_conn():
+    """Return this thread's read-only connection, opening it on first use."""
+    if not hasattr(read_local, 'conn'):
+        read_local.conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+        tune_connection(read_local.conn)
+    return read_local.conn
+
+def get_session():
+    """Build a Session whose pooled keep-alive connections are shared by all crawl threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=100, pool_maxsize=CRAWL_THREADS,
+                          max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                                            raise_on_status=False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 # --- User-Agent Handling ---
 DEFAULT_USER_AGENT = "NovaCrawler/1.1"
 
@@ -74,244 +220,452 @@ USER_AGENTS = [  # Expanded list for stealth mode
     "Dalvik/2.1.0 (Linux; U; Android 11; Pixel 3a XL Build/RQ2A.210305.006)",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36"
 ]
+# Shuffled once, then rotated; next() on a cycle needs no random state shared between threads
+USER_AGENT_CYCLE = cycle(random.sample(USER_AGENTS, len(USER_AGENTS)))
+
+# Built once; get_headers only adds the per-request User-Agent and Referer in stealth mode
+BASE_HEADERS = {
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': DEFAULT_ACCEPT_ENCODING,  # Only what urllib3 can decode; includes br when brotli is installed
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',  # Mimic browser behavior
+    'DNT': '0',
+    'User-Agent': DEFAULT_USER_AGENT
+}
+
+STEALTH_HEADERS = {
+    **BASE_HEADERS,
+    'DNT': '1',  # Respect DNT if requested
+    'Cache-Control': 'max-age=0',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1'
+}
 
 def get_headers(stealth_mode, referrer=None):
-    headers = {
-        'Accept-Language': 'en-US,en;q=0.9',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',  # Mimic browser behavior
-        'DNT': '1' if stealth_mode else '0'  # Respect DNT if requested
-    }
+    if not stealth_mode:
+        return BASE_HEADERS  # requests merges this into a new dict, so sharing it is safe
 
-    if stealth_mode:
-        headers['User-Agent'] = random.choice(USER_AGENTS)
-        headers['Referer'] = referrer if referrer else 'https://novasearch.xyz'  # Dynamic referrer or default
-        headers['Cache-Control'] = 'max-age=0'
-        headers['Sec-Fetch-Dest'] = 'document'
-        headers['Sec-Fetch-Mode'] = 'navigate'
-        headers['Sec-Fetch-Site'] = 'none'
-        headers['Sec-Fetch-User'] = '?1'
-
-    else:
-        headers['User-Agent'] = DEFAULT_USER_AGENT
+    return {
+        **STEALTH_HEADERS,
+        'User-Agent': next(USER_AGENT_CYCLE),
+        'Referer': referrer if referrer else 'https://novasearch.xyz'  # Dynamic referrer or default
+    }
 
-    return headers
+@lru_cache(maxsize=100_000)
+def _split(url):
+    """Memoized urlsplit; its own 128-entry cache is churned through by the crawl threads."""
+    return urlsplit(url)  # urlsplit skips the ;params split that urlparse does
 
-def normalize_url(url):
-    """Remove fragments and trailing slashes, except for specific URLs."""
-    parsed_url = urlparse(url)
-    netloc = parsed_url.netloc
-    
-    if netloc == 'play.google.com' and parsed_url.path == '/store/apps/details':
-        normalized = urlunparse((parsed_url.scheme, netloc, parsed_url.path, '', parsed_url.query, ''))
-    elif netloc == 'youtube.com' or netloc == 'www.youtube.com' and parsed_url.path == '/watch':
-        normalized = urlunparse((parsed_url.scheme, netloc, parsed_url.path, '', parsed_url.query, ''))
-    else:
-        normalized = urlunparse((parsed_url.scheme, netloc, parsed_url.path.rstrip('/'), '', '', ''))
-    return normalized
+def get_domain(url):
+    """Return the URL's host."""
+    return _split(url).netloc
 
 def is_home_page(url):
     """Check if the URL is a home page."""
-    parsed_url = urlparse(url)
-    return parsed_url.path in ('', '/')
-
-def update_priority(url, amount):
-    """Update the priority of a page."""
-    c.execute('UPDATE pages SET priority = priority + ? WHERE url = ?', (amount, url))
-    conn.commit()
-
-def save_page(url, title, description, keywords):
-    """Save a new page to the database with timestamp."""
-    current_time = datetime.now(UTC).isoformat()
-    c.execute('''
-        INSERT INTO pages (url, title, description, keywords, priority, last_crawled)
-        VALUES (?, ?, ?, ?, 0, ?)
-    ''', (url, title, description, keywords, current_time))
-    conn.commit()
-
-def update_page(url, title, description, keywords):
-    """Update an existing page in the database with new timestamp."""
-    current_time = datetime.now(UTC).isoformat()
-    c.execute('''
-        UPDATE pages
-        SET title = ?, 
-            description = ?, 
-            keywords = ?,
-            last_crawled = ?
-        WHERE url = ?
-    ''', (title, description, keywords, current_time, url))
-    conn.commit()
-
-def get_meta_content(soup, name):
+    return _split(url).path in ('', '/')
+
+# last_crawled only moves when the content changed; a revisit earns one extra priority point.
+# SQLite stamps the time itself, in the same ISO-8601 UTC text resultupdater compares against.
+UPSERT_SQL = '''
+    INSERT INTO pages (url, title, description, keywords, priority, last_crawled, domain)
+    VALUES (?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%f', 'now') || '+00:00', ?)
+    ON CONFLICT(url) DO UPDATE SET
+        title = excluded.title,
+        description = excluded.description,
+        keywords = excluded.keywords,
+        last_crawled = CASE
+            WHEN (title, description, keywords) IS NOT (excluded.title, excluded.description, excluded.keywords)
+            THEN excluded.last_crawled ELSE last_crawled END,
+        priority = priority + excluded.priority + 1
+'''
+
+def save_page(url, title, description, keywords, priority):
+    """Insert a page, or refresh it and bump its priority if it is already stored."""
+    queue_write(UPSERT_SQL, (url, title, description, keywords, priority, get_domain(url)))
+
+def get_meta_content(tree, name):
     """Extract meta tag content."""
-    tag = soup.find('meta', attrs={'name': name})
-    return tag['content'] if tag else ''
+    # Plain str: lxml's default "smart" strings keep the whole parsed page alive through their parent
+    content = tree.xpath('//meta[@name=$name]/@content', name=name, smart_strings=False)
+    return content[0] if content else ''
+
+INVALID_EXTENSIONS = (
+    '.css', '.js', '.jpg', '.jpeg', '.png', '.gif', 
+    '.svg', '.woff', '.pdf', '.zip', '.mp4', '.mp3', '.exe'
+)
+# The extension may be followed by a query or fragment, as in logo.png?v=2
+INVALID_EXTENSION = re.compile(r'\.(?:%s)(?:[?#]|$)' % '|'.join(ext[1:] for ext in INVALID_EXTENSIONS), re.IGNORECASE)
+
+def make_joiner(base_url):
+    """Return an href resolver for one page: the base is split once, and common absolute forms skip urljoin."""
+    base = _split(base_url)  # Already cached by the page's own lookups
+    origin = f"{base.scheme}://{base.netloc}"
+
+    def join(href):
+        if href.startswith(('http://', 'https://')):
+            return href
+        if href.startswith('//'):
+            return f"{base.scheme}:{href}"
+        if href.startswith('/') and '/.' not in href:  # Dot segments still need urljoin to resolve them
+            return origin + href
+        return urljoin(base_url, href)
+
+    return join
 
 def is_valid_link(link):
     """Filter non-HTML links."""
-    invalid_extensions = (
-        '.css', '.js', '.jpg', '.jpeg', '.png', '.gif', 
-        '.svg', '.woff', '.pdf', '.zip', '.mp4', '.mp3', '.exe'
-    )
-    return not any(link.lower().endswith(ext) for ext in invalid_extensions)
+    return INVALID_EXTENSION.search(link) is None
 
 def is_same_domain(url1, url2):
     """Check if two URLs belong to the same domain."""
-    domain1 = urlparse(url1).netloc
-    domain2 = urlparse(url2).netloc
-    return domain1 == domain2
-
-def crawl(url, max_depth, session, stealth_mode, visited=set(), saved_urls=set(), 
-          referrer=None, same_domain=False, base_domain=None):
-    """Recursive crawler that collects metadata."""
-    normalized_url = normalize_url(url)
-    
-    # Initialize base_domain on first call
-    if base_domain is None:
-        base_domain = urlparse(normalized_url).netloc
-
-    if max_depth == 0 or normalized_url in visited:
-        return
-
-    # Add same-domain check
-    if same_domain and not is_same_domain(normalized_url, f"https://{base_domain}"):
-        return
-
-    visited.add(normalized_url)
-    tqdm.write(f'Crawling: {normalized_url}')
+    return get_domain(url1) == get_domain(url2)
+
+def find_icon_href(tree):
+    """Return the href of the page's <link rel="icon"> (or "shortcut icon"), if any."""
+    for link in tree.xpath('//link[@rel and @href]'):
+        if "icon" in link.get("rel").lower():
+            return link.get("href")
+    return None
+
+def remember_favicon_url(favicon_urls, url, tree):
+    """Record the domain's favicon URL from an already-parsed page so no second fetch is needed."""
+    domain = get_domain(url)
+    href = find_icon_href(tree)
+    if is_home_page(url):
+        # The home page is what get_favicon_url_from_html would fetch, so it always wins
+        favicon_urls[domain] = urljoin(url, href or '/favicon.ico')
+    elif href:
+        favicon_urls.setdefault(domain, urljoin(url, href))
+
+def is_html(response):
+    """Judge from the headers alone whether a response is an HTML (or XHTML) page."""
+    return 'html' in response.headers.get('Content-Type', '').lower()
+
+def parse_page(response, head_only):
+    """Parse a streamed response into an lxml tree, stopping at <body> when only the head is needed."""
+    parser = lxml.etree.HTMLPullParser(events=('start',), tag='body')
+    received = 0
+    for chunk in response.iter_content(HEAD_CHUNK_SIZE):
+        parser.feed(chunk)
+        received += len(chunk)
+        if head_only and (any(True for _ in parser.read_events()) or received >= MAX_HEAD_BYTES):
+            break  # Closing the response drops the rest of the body unread
+        if received >= MAX_PAGE_BYTES:
+            break  # Whatever has parsed so far, head and early links included, is kept
+    return parser.close()
+
+def fetch_robots(origin, session):
+    """Fetch and parse a host's robots.txt, reading failures the way RFC 9309 does."""
+    rules = RobotFileParser(f"{origin}/robots.txt")
+    try:
+        response = session.get(rules.url, headers=BASE_HEADERS, timeout=5)
+    except requests.RequestException:
+        rules.disallow_all = True  # Unreachable (RFC 9309 2.3.1.4): assume everything is off limits
+        return rules
+
+    if response.status_code == 200:
+        rules.parse(response.text.splitlines())
+    elif 400 <= response.status_code < 500:
+        rules.allow_all = True  # Unavailable, 401 and 403 included (2.3.1.3): nothing is off limits
+    else:
+        rules.disallow_all = True  # 5xx is unreachable too (2.3.1.4)
+    return rules
+
+def robots_allowed(url, session, robots):
+    """Check the URL against its host's robots.txt, cached in the crawl's robots dict, before fetching it."""
+    parts = _split(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    shared = robots.get(origin)
+    if shared is None:
+        # The first thread to reach a new host fetches its robots.txt; the rest wait on that fetch
+        future = Future()
+        shared = robots.setdefault(origin, future)
+        if shared is future:
+            try:
+                future.set_result(fetch_robots(origin, session))
+            except BaseException as e:
+                future.set_exception(e)
+    return shared.result().can_fetch(DEFAULT_USER_AGENT, url)
+
+def crawl_page(url, session, stealth_mode, saved_urls, referrer=None, favicon_urls=None, follow_links=True,
+               robots=None):
+    """Fetch one page, store its metadata and return the links found on it."""
+    log.debug("Crawling: %s", url)
+    robots = {} if robots is None else robots
 
     try:
-        response = session.get(normalized_url, headers=get_headers(stealth_mode, referrer), timeout=5)
+        if not robots_allowed(url, session, robots):
+            log.debug("Skipping disallowed by robots.txt: %s", url)
+            return []
 
-        if response.status_code != 200 or 'text/html' not in response.headers.get('Content-Type', ''):
-            tqdm.write(f"Skipping: {normalized_url} ({response.status_code})")
-            return
+        with session.get(url, headers=get_headers(stealth_mode, referrer), timeout=5, stream=True) as response:
+            # Checked before any of the body is read, so binaries that slipped past is_valid_link cost nothing
+            if response.status_code != 200 or not is_html(response):
+                log.debug("Skipping: %s (%s)", url, response.status_code)
+                return []
 
-        soup = BeautifulSoup(response.content, 'lxml')
+            # Pages on the last level only contribute their head, so their bodies aren't downloaded
+            tree = parse_page(response, head_only=not follow_links)
 
         # Check for noindex meta tag
-        robots_meta = soup.find('meta', attrs={'name': 'robots'})
-        if robots_meta and 'noindex' in robots_meta.get('content', '').lower():
-            tqdm.write(f"Skipping noindex page: {normalized_url}")
-            return
+        if 'noindex' in get_meta_content(tree, 'robots').lower():
+            log.debug("Skipping noindex page: %s", url)
+            return []
 
-        title = soup.title.string if soup.title else ''
-        description = get_meta_content(soup, 'description')
-        keywords = get_meta_content(soup, 'keywords')
+        title = tree.findtext('.//title') or ''
+        description = get_meta_content(tree, 'description')
+        keywords = get_meta_content(tree, 'keywords')
 
         if '404' in title:
-            tqdm.write(f"Skipping 404 page: {normalized_url} (found 404 in title)")
-            return
+            log.debug("Skipping 404 page: %s (found 404 in title)", url)
+            return []
 
-        c.execute('SELECT title, description, keywords, last_crawled FROM pages WHERE url = ?', (normalized_url,))
-        row = c.fetchone()
+        if favicon_urls is not None:
+            remember_favicon_url(favicon_urls, url, tree)
 
-        priority_adjustment = 5 if is_home_page(normalized_url) else 0
+        priority_adjustment = 5 if is_home_page(url) else 0
         priority_adjustment -= 5 if not title else 0
         priority_adjustment -= 3 if not description else 0
         priority_adjustment += 1 if keywords else 0
 
-        if row:
-            stored_title, stored_description, stored_keywords, last_crawled = row
-            if (stored_title != title) or (stored_description != description) or (stored_keywords != keywords):
-                update_page(normalized_url, title, description, keywords)
-                tqdm.write(f"Updated: {title} ({normalized_url})")
-                if last_crawled:
-                    tqdm.write(f"Last crawled: {last_crawled}")
-            update_priority(normalized_url, priority_adjustment + 1)
-        else:
-            save_page(normalized_url, title, description, keywords)
-            saved_urls.add(normalized_url)
-            tqdm.write(f"Saved: {title} ({normalized_url})")
-            update_priority(normalized_url, priority_adjustment)
-
-        for link in soup.find_all('a', href=True):
-            full_url = urljoin(normalized_url, link['href'])
-            if is_valid_link(full_url):
-                crawl(full_url, max_depth - 1, session, stealth_mode, visited, 
-                      saved_urls, referrer=normalized_url, same_domain=same_domain, 
-                      base_domain=base_domain)
+        save_page(url, title, description, keywords, priority_adjustment)
+        saved_urls.add(url)
+        log.info("Saved: %s (%s)", title, url)  # The one line per page shown by default
+
+        if not follow_links:
+            return []
+        join = make_joiner(url)
+        # smart_strings=False, as hrefs outlive the tree in the lru_caches, the frontier and saved_urls
+        links = (join(href) for href in tree.xpath('//a/@href', smart_strings=False))
+        return [normalize_url(link) for link in links if is_valid_link(link)]
 
     except Exception as e:
-        tqdm.write(f'Error: {url} - {e}')
+        log.error('Error: %s - %s', url, e)
+        return []
+
+def run_per_host(executor, pages, fetch):
+    """Run fetch(url, referrer) for each page with at most MAX_PER_HOST per host in flight; {url: result}."""
+    # The cap is applied when submitting rather than inside the workers, so no pool thread sits
+    # waiting on a busy host while pages from other hosts queue up behind it
+    waiting = {}  # host -> deque of (url, referrer) not yet submitted
+    for url, referrer in pages.items():
+        waiting.setdefault(get_domain(url), deque()).append((url, referrer))
+
+    running = {}  # future -> (url, host)
+    def submit(host):
+        url, referrer = waiting[host].popleft()
+        running[executor.submit(fetch, url, referrer)] = (url, host)
+
+    for host, queued in waiting.items():
+        for _ in range(min(MAX_PER_HOST, len(queued))):
+            submit(host)
+
+    results = dict.fromkeys(pages)
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            url, host = running.pop(future)
+            results[url] = future.result()
+            if waiting[host]:
+                submit(host)  # The finished page's slot goes to the next page on the same host
+    return results
+
+def crawl(url, max_depth, session, stealth_mode, visited=None, saved_urls=None, 
+          referrer=None, same_domain=False, base_domain=None, favicon_urls=None):
+    """Breadth-first crawler that fetches each depth level in parallel."""
+    # Holds hash(url) rather than the URL: an int is a fraction of the string's size, and a
+    # 64-bit collision is vanishingly unlikely at crawl sizes; the unique url index stays authoritative
+    visited = set() if visited is None else visited
+    saved_urls = set() if saved_urls is None else saved_urls
+    normalized_url = normalize_url(url)
 
-def get_favicon_url_from_html(domain):
+    if base_domain is None:
+        base_domain = get_domain(normalized_url)
+
+    frontier = {normalized_url: referrer}  # url -> page it was linked from, in discovery order
+    # Per crawl rather than per process: the dashboard re-reads robots.txt on every task,
+    # and the map doesn't keep growing with every host it has ever seen
+    robots = {}  # scheme://host -> Future of its RobotFileParser
+
+    with ThreadPoolExecutor(max_workers=CRAWL_THREADS) as executor:
+        for level in range(max_depth):
+            follow_links = level < max_depth - 1
+
+            def fetch(page_url, page_referrer):
+                return crawl_page(page_url, session, stealth_mode, saved_urls, page_referrer,
+                                  favicon_urls, follow_links, robots)
+
+            pages = {}
+            for page_url, page_referrer in frontier.items():
+                if hash(page_url) in visited:
+                    continue
+                if same_domain and get_domain(page_url) != base_domain:
+                    continue
+                visited.add(hash(page_url))
+                pages[page_url] = page_referrer
+
+            # The next level is every unvisited link found on this one
+            frontier = {}
+            for page_url, links in run_per_host(executor, pages, fetch).items():
+                for link in links:
+                    if hash(link) not in visited:
+                        frontier.setdefault(link, page_url)
+            if not frontier:
+                break
+
+def scan_icon_href(response):
+    """Return the first icon href in a streamed page, reading only as far as it or <body>."""
+    parser = lxml.etree.HTMLPullParser(events=('start',), tag=('link', 'body'))
+    received = 0
+    for chunk in response.iter_content(HEAD_CHUNK_SIZE):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if element.tag == 'body':
+                return None  # Icon links belong in <head>
+            href = element.get('href')
+            if href and 'icon' in element.get('rel', '').lower():
+                return href
+        received += len(chunk)
+        if received >= MAX_HEAD_BYTES:
+            return None
+    return None
+
+def get_favicon_url_from_html(domain, session, favicon_urls=None):
     """Try to find a favicon URL by parsing the HTML of the home page."""
-    try:
-        response = requests.get(f"https://{domain}", headers=get_headers(False), timeout=5)
-        soup = BeautifulSoup(response.content, "html.parser")
+    if favicon_urls and domain in favicon_urls:
+        return favicon_urls[domain]  # Already seen while crawling
 
-        # Search for <link rel="icon"> or <link rel="shortcut icon">
-        icon_link = soup.find("link", rel=lambda value: value and "icon" in value.lower())
-        if icon_link and icon_link.get("href"):
-            return urljoin(f"https://{domain}", icon_link["href"])
-    except requests.RequestException as e:
-        tqdm.write(f"Error fetching HTML from {domain}: {e}")
+    try:
+        with session.get(f"https://{domain}", headers=get_headers(False), timeout=5, stream=True) as response:
+            # Search for <link rel="icon"> or <link rel="shortcut icon">
+            href = scan_icon_href(response)
+            if href:
+                return urljoin(response.url, href)  # Relative to wherever the home page redirected
+    except (requests.RequestException, lxml.etree.LxmlError) as e:
+        log.error("Error fetching HTML from %s: %s", domain, e)
     
     # Fallback to /favicon.ico if not found
     return f"https://{domain}/favicon.ico"
 
-def download_favicon(domain):
-    """Download the favicon for a given domain."""
-    favicon_url = get_favicon_url_from_html(domain)
+def download_favicon(domain, session, favicon_urls=None, cached=None, in_flight=None):
+    """Download the favicon for a given domain, reusing its favicon_cache row when still valid."""
+    cached_url, cached_id, fetched_at, etag, last_modified = cached or (None,) * 5
+    now = int(time.time())
+    if cached_id and now - fetched_at < FAVICON_TTL:
+        return domain, cached_id  # Fetched recently enough that no request is needed
+
+    favicon_url = get_favicon_url_from_html(domain, session, favicon_urls)
+    if in_flight is None:
+        result = fetch_favicon(domain, favicon_url, session, cached)
+    else:
+        # Subdomains and CDN-hosted sites often share one icon URL: the first domain to reach it
+        # downloads it, and the rest wait on that download instead of fetching it again
+        future = Future()
+        shared = in_flight.setdefault(favicon_url, future)
+        if shared is future:
+            try:
+                future.set_result(fetch_favicon(domain, favicon_url, session, cached))
+            except BaseException as e:
+                future.set_exception(e)
+        result = shared.result()
+
+    favicon_id, etag, last_modified = result
+    if favicon_id:
+        queue_write(CACHE_FAVICON_SQL, (domain, favicon_url, favicon_id, now, etag, last_modified))
+    return domain, favicon_id
+
+def fetch_favicon(domain, favicon_url, session, cached=None):
+    """Fetch one favicon URL to disk, returning (favicon_id, etag, last_modified) or Nones on failure."""
+    cached_url, cached_id, fetched_at, etag, last_modified = cached or (None,) * 5
     headers = get_headers(stealth_mode=False)  # Don't need stealth for favicons
+    revalidate = cached_id and favicon_url == cached_url
+    if revalidate:
+        # An unchanged icon then costs a bodiless 304 instead of a download
+        headers = dict(headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
     try:
-        response = requests.get(favicon_url, headers=headers, timeout=5, stream=True)  # Stream for large files
-        response.raise_for_status()  # Raise an exception for bad status codes
-
-        content_type = response.headers.get('Content-Type', '').lower()
-        if content_type.startswith('text/html'):  # Check content type *before* reading content
-            tqdm.write(f"HTML received instead of image for {domain}")
-            return domain, None
-
-        # Identify file extension from content type
-        ext = 'ico'  # Default to ICO if unknown
-        if 'image/png' in content_type:
-            ext = 'png'
-        elif 'image/jpeg' in content_type:
-            ext = 'jpg'
-        elif 'image/svg+xml' in content_type:
-            ext = 'svg'
-        elif 'image/webp' in content_type:
-            ext = 'webp'
-        elif 'image/avif' in content_type:
-            ext = 'avif'
-        elif 'image/gif' in content_type:
-            ext = 'gif'
-
-        # Save the favicon with a hash-based filename
-        favicon_hash = md5(favicon_url.encode()).hexdigest()
-        file_path = os.path.join(FAVICON_DIR, f"{favicon_hash}.{ext}")
-
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-
-        return domain, favicon_hash
+        # Stream for large files; the with block hands the connection back to the pool on every path
+        with session.get(favicon_url, headers=headers, timeout=5, stream=True) as response:
+            if revalidate and response.status_code == 304:
+                return (cached_id, response.headers.get('ETag', etag),
+                        response.headers.get('Last-Modified', last_modified))
+
+            response.raise_for_status()  # Raise an exception for bad status codes
+
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type.startswith('text/html'):  # Check content type *before* reading content
+                log.info("HTML received instead of image for %s", domain)
+                return None, None, None
+
+            # Identify file extension from content type
+            ext = 'ico'  # Default to ICO if unknown
+            if 'image/png' in content_type:
+                ext = 'png'
+            elif 'image/jpeg' in content_type:
+                ext = 'jpg'
+            elif 'image/svg+xml' in content_type:
+                ext = 'svg'
+            elif 'image/webp' in content_type:
+                ext = 'webp'
+            elif 'image/avif' in content_type:
+                ext = 'avif'
+            elif 'image/gif' in content_type:
+                ext = 'gif'
+
+            # Name the file after its content, so domains sharing an icon (e.g. off a CDN) share one file.
+            # The hash is only known once the body is in, so stream to a temp file and rename it into place.
+            digest = blake2b(digest_size=16)
+            fd, partial_path = tempfile.mkstemp(suffix='.partial', dir=FAVICON_DIR)
+            os.fchmod(fd, FAVICON_MODE)  # os.replace keeps the temp file's mode
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_content(16384):  # Straight to disk, never the whole body in memory
+                        digest.update(chunk)
+                        f.write(chunk)
+                favicon_hash = digest.hexdigest()
+                # Atomic, and harmless if another domain already produced the same file
+                os.replace(partial_path, os.path.join(FAVICON_DIR, f"{favicon_hash}.{ext}"))
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+            return favicon_hash, response.headers.get('ETag'), response.headers.get('Last-Modified')
     except requests.RequestException as e:
-        tqdm.write(f"Failed to download favicon from {favicon_url}: {e}")
-
-    return domain, None  # Return None if download fails
-
-def crawl_for_favicons(saved_urls):
-    """Download favicons for all saved URLs using multithreading."""
-    domains = {urlparse(url).netloc for url in saved_urls}
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(download_favicon, domain): domain for domain in domains}
+        log.error("Failed to download favicon from %s: %s", favicon_url, e)
+
+    return None, None, None  # Nothing to record if the download fails
+
+def crawl_for_favicons(saved_urls, session, favicon_urls=None):
+    """Download favicons for saved URLs that don't have one yet using multithreading."""
+    flush_writes()  # Saved pages must be committed before their favicon_id can be checked
+    read_conn = get_read_conn()
+    # One idx_pages_domain_prio lookup per crawled domain rather than one per saved URL
+    domains = [domain for domain in {get_domain(url) for url in saved_urls}
+               if read_conn.execute('SELECT 1 FROM pages WHERE domain = ? AND favicon_id IS NULL LIMIT 1',
+                                    (domain,)).fetchone()]
+
+    in_flight = {}  # favicon URL -> Future of its one download this run
+    with ThreadPoolExecutor(max_workers=FAVICON_THREADS) as executor:
+        futures = {}
+        for domain in domains:
+            cached = read_conn.execute('''
+                SELECT url, favicon_id, fetched_at, etag, last_modified FROM favicon_cache WHERE domain = ?
+            ''', (domain,)).fetchone()
+            futures[executor.submit(download_favicon, domain, session, favicon_urls, cached, in_flight)] = domain
 
         for future in tqdm(as_completed(futures), total=len(futures), desc="Processing favicons"):
             domain, favicon_id = future.result()
             if favicon_id:
-                tqdm.write(f"Downloaded favicon for {domain}")
+                log.info("Downloaded favicon for %s", domain)
 
-                c.execute('''
-                    UPDATE pages SET favicon_id = ?
-                    WHERE url LIKE ?
-                ''', (favicon_id, f'%{domain}%'))
-                conn.commit()
+                queue_write('UPDATE pages SET favicon_id = ? WHERE domain = ?', (favicon_id, domain))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Web crawler with favicon downloader.")
@@ -320,17 +674,23 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--stealth", action="store_true", help="Enable stealth mode (random user-agents)") 
     parser.add_argument("-sd", "--same-domain", action="store_true", 
                         help="Only crawl URLs on the same domain as the starting URL")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Also log every fetched and skipped URL")
     args = parser.parse_args()
 
-    session = requests.Session()
+    log.addHandler(TqdmHandler())
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    session = get_session()
     saved_urls = set()
+    favicon_urls = {}  # domain -> favicon URL found while crawling
 
     print("Starting crawl...")
     crawl(args.url, args.depth, session, args.stealth, saved_urls=saved_urls, 
-          same_domain=args.same_domain)
+          same_domain=args.same_domain, favicon_urls=favicon_urls)
     print("Crawl complete.")
 
     print("Starting favicon crawl...")
-    crawl_for_favicons(saved_urls)
+    crawl_for_favicons(saved_urls, session, favicon_urls)  # Reuses the crawl's open connections
+    flush_writes()
     print("Favicon crawl complete.")
     conn.close()
\ No newline at end of file